@@ -1,4 +1,5 @@
 from collections.abc import Mapping
+from datetime import date
 from functools import wraps
 from itertools import chain
 from hammock import Hammock
@@ -50,6 +51,14 @@ def reorder(entities, positions):
     return ordered
 
 
+def count_tasks(tasks, today=None):
+    """Count tasks, and how many of them are past their due date."""
+    today = (today or date.today()).isoformat()
+    # Due dates are ISO 8601 dates, so they compare correctly as strings.
+    overdue = sum(1 for t in tasks if t.get('due_date', today) < today)
+    return {'count': len(tasks), 'overdue': overdue}
+
+
 def extract(key):
     """Automatically unwrap dict-likes containing a key of interest."""
     def wrapper_builder(f):
@@ -178,3 +187,9 @@ class WunderListAPI(object):
         params = {'revision': task['revision']}
         return (self.client.tasks(task['id'])
                 .DELETE(params=params, headers=self.headers))
+
+    @raise_for_status
+    def delete_subtask(self, subtask):
+        params = {'revision': subtask['revision']}
+        return (self.client.subtasks(subtask['id'])
+                .DELETE(params=params, headers=self.headers))
@@ -1,7 +1,9 @@
 import os
+import sys
 import yaml
 from .api import WunderListAPI
 from .controller import Controller
+from .store import EntityStore, DEFAULT_BUDGET
 from .view import View
 
 
@@ -10,7 +12,11 @@ def main():
                                      os.path.expanduser('~/.wutrc'))
     with open(config_filename) as f:
         config = yaml.load(f)
-    model = WunderListAPI(config['client_id'], config['access_token'])
+    model = EntityStore(WunderListAPI(config['client_id'],
+                                      config['access_token']),
+                        budget=config.get('cache_budget', DEFAULT_BUDGET))
     view = View()
     controller = Controller(model, view)
     controller.run()
+    if os.environ.get('WUT_FRAME_STATS'):
+        print('Rendered', controller.frame_stats, file=sys.stderr)
@@ -1,6 +1,14 @@
-from functools import partial
+from concurrent.futures import Future
+from functools import partial, wraps
+import os
+import queue
+import threading
+import time
 import urwid
 
+from .api import count_tasks
+from .store import container_key
+
 
 class SubController(urwid.WidgetWrap):
     """Base class for sub-controllers concerned with a single function.
@@ -28,34 +36,108 @@ class SubController(urwid.WidgetWrap):
 
 
 class ListsController(SubController):
-    """Controller that handles the list selection dialog."""
+    """Controller that handles the list selection dialog.
+
+    Each list is labelled with its number of uncompleted and overdue
+    tasks. The tasks are fetched concurrently after the lists themselves
+    have been drawn and go into the store, so opening a list afterwards
+    reuses them. From then on the counts are adjusted as tasks are
+    created, completed and deleted rather than fetched again.
+
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counts = {}
+
     def refresh(self):
         lists = self.model.lists()
         self.view.populate(lists)
+        for list_ in lists:
+            if list_['id'] in self.counts:
+                continue
+            counts = self.model.cached_task_counts(list_)
+            if counts is not None:
+                self.set_counts(list_['id'], counts)
+            else:
+                self.root.run_in_background(
+                    self.model.fetcher(list_),
+                    partial(self._fetched, list_)
+                )
+
+    def _fetched(self, list_, result):
+        tasks = self.model.put(list_, False, *result)
+        if tasks is not None:
+            self.set_counts(list_['id'], count_tasks(tasks))
+
+    def set_counts(self, list_id, counts):
+        self.counts[list_id] = counts
+        self.view.set_counts(list_id, counts)
+
+    def adjust_counts(self, task, delta):
+        """Account for ``delta`` uncompleted tasks like ``task``."""
+        counts = self.counts.get(task['list_id'])
+        if counts is None:
+            # Still being fetched; the result will be close enough.
+            return
+        overdue = count_tasks([task])['overdue']
+        self.set_counts(task['list_id'],
+                        {'count': counts['count'] + delta,
+                         'overdue': counts['overdue'] + delta * overdue})
 
     def handler(self, widget, user_data):
         self.root.select_list(user_data)
 
 
 class TasksController(SubController):
-    """Controller that handles the tasks/subtasks selection dialog."""
+    """Controller that handles the tasks/subtasks selection dialog.
+
+    In tree mode (toggled with ``t``), ``s`` expands a task's subtasks in
+    place instead of switching to them, and ``left`` collapses them again.
+    Subtasks of the tasks around the focus are prefetched in the
+    background once the focus settles.
+
+    Tasks and subtasks already in the store are shown straight away and,
+    unless fetched within the last ``revalidate_after`` seconds, refetched
+    in the background, so that changes made from other clients show up
+    shortly after. Only what actually changed is redrawn.
+
+    """
     completion_timeout = 0.8
+    prefetch_delay = 0.3
+    prefetch_radius = 3
+    revalidate_after = 30
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.show_completed = False
+        self.tree_mode = False
+        self.expanded = set()
+        self._prefetching = set()
+        self._prefetch_alarm = None
+        self._revalidating = set()
+        self._refresh_alarm = None
 
     def keypress(self, size, key):
-        if key == 'backspace' or key == 'left':
+        if key == 'left' and self.expanded_focus() is not None:
+            self.collapse(self.expanded_focus())
+        elif key == 'backspace' or key == 'left':
             self.abort()
         elif key.lower() == 'r':
-            return self.refresh()
+            return self.refresh(refetch=True)
         elif key.lower() == 'n':
             self.root.display_create_dialog()
         elif key.lower() == 'e':
             self.root.display_edit_dialog()
         elif key.lower() == 's' and self.active_record['type'] == 'list':
-            self.active_record = self.view.focus_entity
+            if not self.tree_mode:
+                self.active_record = self.view.focus_entity
+                self.refresh()
+            elif self.expanded_focus() is not None:
+                self.collapse(self.expanded_focus())
+            else:
+                self.expand(self.view.focus_entity)
+        elif key.lower() == 't':
+            self.tree_mode = not self.tree_mode
             self.refresh()
         elif key.lower() == 'c':
             self.show_completed = not self.show_completed
@@ -63,10 +145,14 @@ class TasksController(SubController):
         elif key.lower() == 'd':
             self.root.display_delete_dialog()
         else:
-            return super().keypress(size, key)
+            key = super().keypress(size, key)
+            if self.tree_mode:
+                self._schedule_prefetch()
+            return key
 
     def abort(self):
         if self.active_record['type'] == 'list':
+            self._cancel_prefetch()
             self.root.display_list_selection()
         else:
             assert self.active_record['type'] == 'task'
@@ -86,28 +172,170 @@ class TasksController(SubController):
         else:
             self.refresh(reset_focus=True)
 
-    def refresh(self, reset_focus=False):
-        if self.active_record['type'] == 'list':
-            f = self.model.tasks
-        else:
-            assert self.active_record['type'] == 'task'
-            f = self.model.subtasks
-        entities = f(self.active_record, completed=self.show_completed)
+    def refresh(self, reset_focus=False, refetch=False, revalidate=True):
+        self.model.pin([self.active_record], completed=self.show_completed)
+        entities = self._contents(self.active_record, refetch, revalidate)
+        if self.active_record['type'] == 'list' and not self.show_completed:
+            # Got these for free, may as well keep the badge accurate.
+            self.root.lists_controller.set_counts(self.active_record['id'],
+                                                  count_tasks(entities))
+        self.view.tree = (self.tree_mode and
+                          self.active_record['type'] == 'list')
+        if self.view.tree:
+            expanded = [e for e in entities if e['id'] in self.expanded]
+            self.model.pin([self.active_record] + expanded,
+                           completed=self.show_completed)
+            rows = []
+            for entity in entities:
+                rows.append(entity)
+                if entity['id'] in self.expanded:
+                    rows.extend(self._contents(entity, refetch,
+                                               revalidate))
+            entities = rows
+            self._schedule_prefetch()
         self.view.populate(entities, reset_focus=reset_focus)
 
+    def _contents(self, container, refetch=False, revalidate=True):
+        completed = self.show_completed
+        entities = None if refetch else self.model.cached(container,
+                                                          completed)
+        if entities is None:
+            return self.model.contents(container, completed, refresh=True)
+        key = container_key(container, completed)
+        if (revalidate and key not in self._revalidating and
+                self.model.age(container, completed) > self.revalidate_after):
+            self._revalidating.add(key)
+            self.root.run_in_background(
+                self.model.fetcher(container, completed),
+                partial(self._revalidated, container, completed),
+                partial(self._revalidation_failed, key)
+            )
+        return entities
+
+    def _revalidated(self, container, completed, result):
+        key = container_key(container, completed)
+        self._revalidating.discard(key)
+        entities = self.model.put(container, completed, *result)
+        if entities is None or completed != self.show_completed:
+            # Overtaken by a local change (what we have is newer), or no
+            # longer what we're showing.
+            return
+        if key == container_key(self.active_record, completed):
+            self._schedule_refresh()
+        elif (self.view.tree and container['id'] in self.expanded and
+                container in self.view.entities):
+            self.view.expand(container, entities)
+
+    def _revalidation_failed(self, key, exception):
+        self._revalidating.discard(key)
+
+    def _schedule_refresh(self):
+        # Results that arrive together get a single refresh between them.
+        if self._refresh_alarm is None:
+            self._refresh_alarm = self.set_alarm_in(0, self._deferred_refresh)
+
+    def _deferred_refresh(self, *args):
+        self._refresh_alarm = None
+        self.refresh(revalidate=False)
+
+    def expanded_focus(self):
+        """The expanded task that the focus is on or under, if any."""
+        if not self.tree_mode:
+            return None
+        try:
+            entity = self.view.focus_entity
+        except IndexError:
+            return None
+        if entity['type'] == 'subtask':
+            return self.view.parent_of(entity)
+        elif entity['id'] in self.expanded:
+            return entity
+
+    def expand(self, task):
+        self.expanded.add(task['id'])
+        self._pin_expanded()
+        if (task['id'] in self._prefetching and
+                self.model.cached(task, self.show_completed) is None):
+            # Already on its way, _prefetched will show it.
+            return
+        self.view.expand(task, self._contents(task))
+
+    def collapse(self, task):
+        self.expanded.discard(task['id'])
+        self.view.collapse(task)
+        self._pin_expanded()
+
+    def _pin_expanded(self):
+        self.model.pin([self.active_record] +
+                       [e for e in self.view.entities
+                        if e['type'] == 'task' and e['id'] in self.expanded],
+                       completed=self.show_completed)
+
+    def _schedule_prefetch(self):
+        # Wait for the focus to settle so scrolling doesn't fire off
+        # requests for every row it passes.
+        self._cancel_prefetch()
+        if self.root.active_controller is self.root.lists_controller:
+            return
+        self._prefetch_alarm = self.set_alarm_in(self.prefetch_delay,
+                                                 self._prefetch,
+                                                 redraw=False)
+
+    def _cancel_prefetch(self):
+        if self._prefetch_alarm is not None:
+            self.remove_alarm(self._prefetch_alarm)
+            self._prefetch_alarm = None
+
+    def _prefetch(self, *args):
+        self._prefetch_alarm = None
+        completed = self.show_completed
+        for task in self.view.near_focus(self.prefetch_radius):
+            if (task['type'] != 'task' or task['id'] in self.expanded or
+                    task['id'] in self._prefetching or
+                    self.model.cached(task, completed) is not None):
+                continue
+            self._prefetching.add(task['id'])
+            # Only the request happens in the worker; the store is updated
+            # from the main loop, in _prefetched.
+            self.root.run_in_background(
+                self.model.fetcher(task, completed),
+                partial(self._prefetched, task, completed),
+                partial(self._prefetch_failed, task)
+            )
+
+    def _prefetched(self, task, completed, result):
+        self._prefetching.discard(task['id'])
+        subtasks = self.model.put(task, completed, *result)
+        if subtasks is None:
+            subtasks = self.model.cached(task, completed)
+        if subtasks is None:
+            self._prefetch_failed(task, None)
+        elif (completed == self.show_completed and self.view.tree and
+                task['id'] in self.expanded and task in self.view.entities):
+            self.view.expand(task, subtasks)
+
+    def _prefetch_failed(self, task, exception):
+        self._prefetching.discard(task['id'])
+        if self.model.cached(task, self.show_completed) is None:
+            # Don't leave it looking expanded if expand was waiting on us.
+            self.expanded.discard(task['id'])
+
     def create_entity(self, **kwargs):
         if self.active_record['type'] == 'list':
             endpoint = self.model.create_task
         else:
             assert self.active_record['type'] == 'task'
             endpoint = self.model.create_subtask
-        return endpoint(self.active_record['id'], **kwargs)
+        entity = endpoint(self.active_record['id'], **kwargs)
+        if entity['type'] == 'task' and not entity['completed']:
+            self.root.lists_controller.adjust_counts(entity, 1)
+        return entity
 
     def update_entity(self, entity, **kwargs):
-        if self.active_record['type'] == 'list':
+        if entity['type'] == 'task':
             return self.model.update_task(entity, **kwargs)
         else:
-            assert self.active_record['type'] == 'task'
+            assert entity['type'] == 'subtask'
             return self.model.update_subtask(entity, **kwargs)
 
     def handler(self, widget, new_state, task):
@@ -126,6 +354,8 @@ class TasksController(SubController):
         if task['type'] == 'task':
             self.model.update_task(task, completed=new_state)
             self.view.remove_task_element(widget)
+            self.root.lists_controller.adjust_counts(task,
+                                                     -1 if new_state else 1)
         else:
             assert task['type'] == 'subtask'
             self.model.update_subtask(task, completed=new_state)
@@ -192,6 +422,8 @@ class DeleteController(TaskPopup):
     def handler(self, entity, widget):
         if entity['type'] == 'task':
             self.model.delete_task(entity)
+            if not entity['completed']:
+                self.root.lists_controller.adjust_counts(entity, -1)
         else:
             assert entity['type'] == 'subtask'
             self.model.delete_subtask(entity)
@@ -199,6 +431,27 @@ class DeleteController(TaskPopup):
         self.root.display_task_list()
 
 
+class FrameStats(object):
+    """Running count of frames drawn and the time spent rendering them."""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.last = 0.
+
+    def record(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        self.last = elapsed
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+    def __str__(self):
+        return '{} frames, {:.1f} ms mean, {:.1f} ms last'.format(
+            self.count, 1000 * self.mean, 1000 * self.last)
+
+
 class Controller(urwid.MainLoop):
     """Root controller for the application.
 
@@ -206,10 +459,27 @@ class Controller(urwid.MainLoop):
     (aliased as ``active_controller``), adding/removing alarms, unhandled
     keyboard input, etc.
 
+    Redraws are throttled to at most one per ``frame_interval`` seconds:
+    input and alarms only mark the screen dirty, and whatever changes
+    pile up before the next frame (a burst of key repeats, several view
+    updates from one callback) are rendered together.
+
     """
+    frame_interval = 1 / 30
+    background_workers = 8
+
     def __init__(self, model, view):
         self.model = model
         self.view = view
+        self.frame_stats = FrameStats()
+        self._dirty = True
+        self._last_frame = 0.
+        self._frame_alarm = None
+        self._jobs = queue.Queue()
+        self._finished = queue.Queue()
+        # Daemons, so that quitting never waits on a slow request.
+        for _ in range(self.background_workers):
+            threading.Thread(target=self._work, daemon=True).start()
         self.tasks_controller = TasksController(self, view.tasks_view)
         self.lists_controller = ListsController(self, view.lists_view)
         self.create_controller = CreateController(self, view.create_view)
@@ -220,11 +490,103 @@ class Controller(urwid.MainLoop):
         super().__init__(self.lists_controller,
                          view.palette,
                          unhandled_input=self.keypress)
+        self._wakeup = self.watch_pipe(self._deliver_results)
 
     def keypress(self, key):
         if key.lower() == 'q':
             raise urwid.ExitMainLoop()
 
+    def process_input(self, keys):
+        self._dirty = True
+        return super().process_input(keys)
+
+    def set_alarm_in(self, sec, callback, user_data=None, redraw=True):
+        """Like ``MainLoop.set_alarm_in``.
+
+        Pass ``redraw=False`` for callbacks that don't change anything on
+        screen, so that they don't cost a frame.
+
+        """
+        if not redraw:
+            return super().set_alarm_in(sec, callback, user_data)
+
+        @wraps(callback)
+        def wrapped(loop, user_data):
+            self._dirty = True
+            return callback(loop, user_data)
+        return super().set_alarm_in(sec, wrapped, user_data)
+
+    def run_in_background(self, func, callback, errback=None):
+        """Call ``func`` in a worker thread.
+
+        ``callback`` is then called with its result from the main loop,
+        where it is safe to touch the widgets. If ``func`` raises,
+        ``errback`` (if any) is called with the exception instead; either
+        way, background failures never take down the main loop.
+
+        """
+        future = Future()
+        future.add_done_callback(partial(self._finish, callback, errback))
+        self._jobs.put((future, func))
+        return future
+
+    def _work(self):
+        while True:
+            future, func = self._jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = func()
+            except Exception as exception:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    def _finish(self, callback, errback, future):
+        if future.cancelled() or self._wakeup is None:
+            return
+        self._finished.put((callback, errback, future))
+        try:
+            os.write(self._wakeup, b'.')
+        except OSError:
+            # Closed while we were finishing up; nobody is listening.
+            pass
+
+    def _deliver_results(self, data):
+        self._dirty = True
+        while True:
+            try:
+                callback, errback, future = self._finished.get_nowait()
+            except queue.Empty:
+                return True
+            exception = future.exception()
+            if exception is None:
+                callback(future.result())
+            elif errback is not None:
+                errback(exception)
+
+    def entering_idle(self):
+        if not self._dirty or self._frame_alarm is not None:
+            return
+        wait = self._last_frame + self.frame_interval - time.monotonic()
+        if wait > 0:
+            self._frame_alarm = self.set_alarm_in(wait, self._draw_frame,
+                                                  redraw=False)
+        else:
+            super().entering_idle()
+
+    def _draw_frame(self, loop, user_data):
+        self._frame_alarm = None
+        if self._dirty:
+            super().entering_idle()
+
+    def draw_screen(self):
+        start = time.monotonic()
+        super().draw_screen()
+        self._last_frame = time.monotonic()
+        self._dirty = False
+        self.frame_stats.record(self._last_frame - start)
+
     @property
     def active_controller(self):
         return self.widget
@@ -235,11 +597,22 @@ class Controller(urwid.MainLoop):
 
     def run(self, *args, **kwargs):
         self.active_controller.refresh()
-        super().run(*args, **kwargs)
+        try:
+            super().run(*args, **kwargs)
+        finally:
+            while True:
+                try:
+                    future, _ = self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+                future.cancel()
+            wakeup, self._wakeup = self._wakeup, None
+            self.remove_watch_pipe(wakeup)
+            os.close(wakeup)
 
     def select_list(self, list_descr):
-        self.tasks_controller.active_record = list_descr
         self.display_task_list()
+        self.tasks_controller.active_record = list_descr
 
     def display_list_selection(self):
         self.active_controller = self.lists_controller
@@ -0,0 +1,291 @@
+from collections import OrderedDict
+from functools import partial
+import sys
+import time
+
+from .api import count_tasks
+
+
+DEFAULT_BUDGET = 64 * 2 ** 20
+
+
+def approximate_size(entity):
+    """Rough number of bytes taken up by a (flat) entity dict."""
+    return sys.getsizeof(entity) + sum(sys.getsizeof(k) + sys.getsizeof(v)
+                                       for k, v in entity.items())
+
+
+def entity_key(entity):
+    return entity['type'], entity['id']
+
+
+def collection_key(entity):
+    """Key of the collection an entity is listed under."""
+    if entity['type'] == 'task':
+        return 'tasks', entity['list_id'], entity['completed']
+    else:
+        assert entity['type'] == 'subtask'
+        return 'subtasks', entity['task_id'], entity['completed']
+
+
+def container_key(container, completed):
+    """Key of the collection listing the contents of a list or task."""
+    if container['type'] == 'list':
+        return 'tasks', container['id'], completed
+    else:
+        assert container['type'] == 'task'
+        return 'subtasks', container['id'], completed
+
+
+class EntityStore(object):
+    """Caching wrapper around ``WunderListAPI``.
+
+    Tasks and subtasks are kept once per id, so that every view (and every
+    widget's ``user_data``) refers to the same dict, and updates are
+    applied to that dict in place.
+
+    They are cached per collection (the completed or uncompleted tasks of
+    a list, or subtasks of a task). When the approximate size of the cache
+    exceeds ``budget`` bytes, collections are evicted least recently used
+    first, subtasks before tasks. Pinned collections (those on screen)
+    are never evicted.
+
+    Nothing here expires by itself; callers that want fresh data
+    ``fetch`` it and ``put`` the result. Fetched entities never replace
+    ones with a higher revision, and results requested before a local
+    create, update or delete in the same collection are thrown away.
+
+    Not thread-safe: the store changes entity dicts that are on screen,
+    so everything must be called from the main loop, except for the
+    callables returned by ``fetcher``, which only make requests.
+
+    """
+    def __init__(self, model, budget=DEFAULT_BUDGET):
+        self.model = model
+        self.budget = budget
+        self.size = 0
+        self._entities = {}
+        self._sizes = {}
+        self._collections = OrderedDict()
+        self._collection_sizes = {}
+        self._owners = {}
+        self._generations = {}
+        self._fetched_at = {}
+        self._pinned = frozenset()
+
+    def lists(self, *args, **kwargs):
+        return self.model.lists(*args, **kwargs)
+
+    def list(self, id_):
+        return self.model.list(id_)
+
+    def task(self, id_):
+        return self.model.task(id_)
+
+    def tasks(self, list_, completed=False, refresh=False):
+        return self.contents(list_, completed, refresh)
+
+    def subtasks(self, task, completed=False, refresh=False):
+        return self.contents(task, completed, refresh)
+
+    def contents(self, container, completed=False, refresh=False):
+        """Tasks of a list or subtasks of a task, cached if possible."""
+        entities = None if refresh else self.cached(container, completed)
+        if entities is None:
+            entities = self.put(container, completed,
+                                self.fetch(container, completed))
+        return entities
+
+    def cached(self, container, completed=False):
+        """Cached contents of a list or task, or ``None``."""
+        key = container_key(container, completed)
+        if key not in self._collections:
+            return None
+        self._collections.move_to_end(key)
+        return [self._entities[k] for k in self._collections[key]]
+
+    def age(self, container, completed=False):
+        """Seconds since the contents of a list or task were fetched.
+
+        ``None`` if they aren't cached.
+
+        """
+        key = container_key(container, completed)
+        if key not in self._collections:
+            return None
+        return time.monotonic() - self._fetched_at[key]
+
+    def fetch(self, container, completed=False):
+        """Request the contents of a list or task, bypassing the cache."""
+        if container['type'] == 'list':
+            return self.model.tasks(container, completed=completed)
+        else:
+            assert container['type'] == 'task'
+            return self.model.subtasks(container, completed=completed)
+
+    def fetcher(self, container, completed=False):
+        """A ``fetch`` to be called from a worker thread.
+
+        It works on a copy of ``container``, which may be rewritten in
+        place by the main loop meanwhile, and returns the contents along
+        with the generation they were requested at, to pass on to ``put``.
+
+        """
+        generation = self._generations.get(container_key(container,
+                                                          completed), 0)
+        return partial(self._fetch_at, dict(container), completed,
+                       generation)
+
+    def _fetch_at(self, container, completed, generation):
+        return self.fetch(container, completed), generation
+
+    def put(self, container, completed, entities, generation=None):
+        """Replace the cached contents of a list or task.
+
+        Returns the canonical instances of ``entities``, or ``None`` if
+        they were requested (at ``generation``) before a local change to
+        the collection and so are out of date.
+
+        """
+        key = container_key(container, completed)
+        if (generation is not None and
+                generation < self._generations.get(key, 0)):
+            return None
+        # Skip anything we know has since moved to another collection.
+        entities = [e for e in map(self._intern, entities)
+                    if collection_key(e) == key]
+        keys = [entity_key(e) for e in entities]
+        for stale in set(self._collections.get(key, ())) - set(keys):
+            self._entities.pop(stale, None)
+            self._sizes.pop(stale, None)
+        self._collections[key] = keys
+        self._collections.move_to_end(key)
+        self._fetched_at[key] = time.monotonic()
+        if container['type'] == 'list':
+            self._owners[key] = container['id']
+        else:
+            self._owners[key] = container['list_id']
+        self._account(key)
+        self._evict()
+        return entities
+
+    def cached_task_counts(self, list_):
+        tasks = self.cached(list_)
+        return None if tasks is None else count_tasks(tasks)
+
+    def create_task(self, list_id, **kwargs):
+        return self._merge(self.model.create_task(list_id, **kwargs))
+
+    def create_subtask(self, task_id, **kwargs):
+        return self._merge(self.model.create_subtask(task_id, **kwargs))
+
+    def update_task(self, task, **kwargs):
+        return self._merge(self.model.update_task(task, **kwargs))
+
+    def update_subtask(self, subtask, **kwargs):
+        return self._merge(self.model.update_subtask(subtask, **kwargs))
+
+    def delete_task(self, task):
+        result = self.model.delete_task(task)
+        self._touch(collection_key(task))
+        self._discard(collection_key(task), entity_key(task))
+        for completed in (False, True):
+            subtasks = container_key(task, completed)
+            self._touch(subtasks)
+            if subtasks in self._collections:
+                self._drop(subtasks)
+        return result
+
+    def delete_subtask(self, subtask):
+        result = self.model.delete_subtask(subtask)
+        self._touch(collection_key(subtask))
+        self._discard(collection_key(subtask), entity_key(subtask))
+        return result
+
+    def pin(self, containers, completed=False):
+        """Protect the contents of ``containers`` from eviction.
+
+        Replaces whatever was pinned before.
+
+        """
+        self._pinned = frozenset(container_key(c, completed)
+                                 for c in containers)
+
+    def list_size(self, list_id):
+        """Approximate bytes cached for a list, including its subtasks."""
+        return sum(self._collection_sizes[key]
+                   for key, owner in self._owners.items()
+                   if owner == list_id)
+
+    def _intern(self, entity):
+        key = entity_key(entity)
+        existing = self._entities.get(key)
+        if existing is not None:
+            if entity.get('revision', 0) < existing.get('revision', 0):
+                return existing
+            old_collection = collection_key(existing)
+            if existing is not entity:
+                existing.clear()
+                existing.update(entity)
+                entity = existing
+            if old_collection != collection_key(entity):
+                self._discard(old_collection, key)
+        self._entities[key] = entity
+        self._sizes[key] = approximate_size(entity)
+        return entity
+
+    def _merge(self, entity):
+        """Fold a created or updated entity into its cached collection."""
+        existing = self._entities.get(entity_key(entity))
+        if existing is not None:
+            self._touch(collection_key(existing))
+        self._touch(collection_key(entity))
+        entity = self._intern(entity)
+        key, collection = entity_key(entity), collection_key(entity)
+        if collection in self._collections:
+            keys = self._collections[collection]
+            if key not in keys:
+                # New ids come first, see ``reorder``.
+                keys.insert(0, key)
+            self._account(collection)
+            self._evict()
+        else:
+            # Nothing to list it under; don't hold on to it.
+            del self._entities[key]
+            del self._sizes[key]
+        return entity
+
+    def _touch(self, collection):
+        """Note a local change, outdating requests already in flight."""
+        self._generations[collection] = self._generations.get(collection,
+                                                              0) + 1
+
+    def _discard(self, collection, key):
+        self._entities.pop(key, None)
+        self._sizes.pop(key, None)
+        if collection in self._collections:
+            keys = self._collections[collection]
+            if key in keys:
+                keys.remove(key)
+            self._account(collection)
+
+    def _account(self, collection):
+        size = sum(self._sizes[k] for k in self._collections[collection])
+        self.size += size - self._collection_sizes.get(collection, 0)
+        self._collection_sizes[collection] = size
+
+    def _drop(self, collection):
+        for key in self._collections.pop(collection):
+            del self._entities[key]
+            del self._sizes[key]
+        self.size -= self._collection_sizes.pop(collection)
+        del self._owners[collection]
+        del self._fetched_at[collection]
+
+    def _evict(self):
+        for kind in ('subtasks', 'tasks'):
+            for collection in list(self._collections):
+                if self.size <= self.budget:
+                    return
+                if collection[0] == kind and collection not in self._pinned:
+                    self._drop(collection)
@@ -28,6 +28,24 @@ def preserve_focus(widget, delta=0, reset=False):
             pass
 
 
+@contextmanager
+def preserve_focus_entity(pile, reset=False):
+    """Like ``preserve_focus``, but follows the focused entity if it moves."""
+    try:
+        focused = pile[pile.focus_position]
+    except IndexError:
+        focused = None
+    with preserve_focus(pile, reset=reset):
+        yield
+    if focused is None or reset:
+        return
+    for index, entity in enumerate(pile):
+        if (entity['type'], entity['id']) == (focused['type'],
+                                              focused['id']):
+            pile.focus_position = index
+            break
+
+
 class SelectorView(urwid.WidgetWrap):
     def __init__(self):
         self._pile = self.pile_class()
@@ -50,10 +68,25 @@ class TasksView(SelectorView):
     pile_class = TaskPile
 
     def populate(self, tasks, reset_focus=False):
-        with preserve_focus(self._pile, reset=reset_focus):
+        if not reset_focus and self._pile.unchanged(tasks):
+            return
+        with preserve_focus_entity(self._pile, reset=reset_focus):
             self._pile.clear()
             self._pile.extend(tasks)
 
+    @property
+    def tree(self):
+        """Whether subtasks are shown indented under their tasks."""
+        return self._pile.tree
+
+    @tree.setter
+    def tree(self, value):
+        self._pile.tree = value
+
+    @property
+    def entities(self):
+        return self._pile.entities
+
     @property
     def focus_entity(self):
         return self._pile[self._pile.focus_position]
@@ -69,11 +102,58 @@ class TasksView(SelectorView):
     def remove_task_element(self, element):
         index, = [idx for idx, (elem, _) in enumerate(self._pile.contents)
                   if elem == element or elem.base_widget == element]
+        for _ in range(index + 1, self._subtasks_end(index)):
+            del self._pile[index + 1]
         del self._pile[index]
 
     def replace_task_element(self, index, task):
         self._pile[index] = task
 
+    def near_focus(self, radius):
+        """Entities within ``radius`` rows of the focus."""
+        try:
+            focus = self._pile.focus_position
+        except IndexError:
+            return []
+        return self._pile.entities[max(focus - radius, 0):focus + radius + 1]
+
+    def parent_of(self, subtask):
+        for entity in self._pile:
+            if entity['type'] == 'task' and entity['id'] == subtask['task_id']:
+                return entity
+
+    def expand(self, task, subtasks):
+        """Show ``subtasks`` under ``task``, replacing any shown already."""
+        index = self._pile.entities.index(task)
+        end = self._subtasks_end(index)
+        if self._pile.unchanged(subtasks, index + 1, end):
+            return
+        with preserve_focus_entity(self._pile):
+            for _ in range(index + 1, end):
+                del self._pile[index + 1]
+            for offset, subtask in enumerate(subtasks, index + 1):
+                self._pile.insert(offset, subtask)
+
+    def collapse(self, task):
+        index = self._pile.entities.index(task)
+        end = self._subtasks_end(index)
+        focus = self._pile.focus_position
+        for _ in range(index + 1, end):
+            del self._pile[index + 1]
+        if focus >= end:
+            self._pile.focus_position = focus - (end - index - 1)
+        elif focus > index:
+            self._pile.focus_position = index
+
+    def _subtasks_end(self, index):
+        """Index just past the subtask rows shown under a task."""
+        task, end = self._pile[index], index + 1
+        while (task['type'] == 'task' and end < len(self._pile) and
+               self._pile[end]['type'] == 'subtask' and
+               self._pile[end]['task_id'] == task['id']):
+            end += 1
+        return end
+
 
 class ListsView(SelectorView):
     pile_class = ListPile
@@ -83,6 +163,15 @@ class ListsView(SelectorView):
             self._pile.clear()
             self._pile.extend(lists)
 
+    def set_counts(self, list_id, counts):
+        """Update the task count badge of a single list button."""
+        self._pile.counts[list_id] = counts
+        for index, list_ in enumerate(self._pile):
+            if list_['id'] == list_id:
+                with preserve_focus(self._pile):
+                    self._pile[index] = list_
+                break
+
 
 class DialogOverlay(urwid.Overlay):
     def __init__(self, widget, underneath, **kwargs):
@@ -44,7 +44,19 @@ class EntityPile(MutableSequence, urwid.Pile, metaclass=ABCMetaWidget):
         self.entities = []
 
     def construct_element_for(self, value):
-        return (self.build_widget(value), self.style)
+        widget = self.build_widget(value)
+        # Entities may be updated in place, so remember what we drew.
+        widget.revision = value.get('revision')
+        return (widget, self.style)
+
+    def unchanged(self, values, start=0, stop=None):
+        """Whether rows ``start:stop`` already show exactly ``values``."""
+        rows = self.contents[start:stop]
+        return (len(rows) == len(values) and
+                all(entity is value and
+                    widget.revision == value.get('revision')
+                    for entity, (widget, _), value
+                    in zip(self.entities[start:stop], rows, values)))
 
     def insert(self, index, value):
         self.contents.insert(index, self.construct_element_for(value))
@@ -73,16 +85,36 @@ class CallbackEntityPile(EntityPile):
 
 
 class TaskPile(CallbackEntityPile):
+    tree = False
+    indent = 4
+
     def build_widget(self, task):
         checkbox = urwid.CheckBox(task['title'],
                                   on_state_change=self.callback,
                                   state=task['completed'],
                                   user_data=task)
+        if self.tree and task['type'] == 'subtask':
+            checkbox = urwid.Padding(checkbox, left=self.indent)
         return urwid.AttrMap(checkbox, None, focus_map='reversed')
 
 
 class ListPile(CallbackEntityPile):
+    def __init__(self, callback=None):
+        super().__init__(callback)
+        self.counts = {}
+
     def build_widget(self, list_):
-        button = urwid.Button(list_['title'], on_press=self.callback,
+        button = urwid.Button(self.label(list_), on_press=self.callback,
                               user_data=list_)
         return urwid.AttrMap(button, None, focus_map='reversed')
+
+    def label(self, list_):
+        counts = self.counts.get(list_['id'])
+        if counts is None:
+            return list_['title']
+        elif counts['overdue']:
+            return '{} ({}, {} overdue)'.format(list_['title'],
+                                                counts['count'],
+                                                counts['overdue'])
+        else:
+            return '{} ({})'.format(list_['title'], counts['count'])